@@ -1,16 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import logging
-import json
 import sys
-import re
-import io
 import signal
 import typing as t
 import dataclasses
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import gi
+import orjson
 
 gi.require_version("GLib", "2.0")
 gi.require_version("Gio", "2.0")
@@ -24,22 +26,24 @@ from gi.repository import OSTree
 
 PROGRAM_NAME = "flatpak-remote-metadata"
 
-MEATADATA_TYPES = [
-    (re.compile(g), re.compile(k), t)
-    for g, k, t in [
-        (r"Context", r".*", list),
-        (r"Extension \S+", r"autodelete", bool),
-        (r"Extension \S+", r"no-autodownload", bool),
-        (r"Extension \S+", r"subdirectories", bool),
-        (r"Extension \S+", r"locale-subset", bool),
-        (r"Extension \S+", r"versions", list),
-        (r"Extension \S+", r"merge-dirs", list),
-        (r"ExtensionOf", r"priority", int),
-        (r"(Application|Runtime)", r"required-flatpak", list),
-        (r"(Application|Runtime)", r"tags", list),
-        (r"Build", r"built-extensions", list),
-    ]
-]
+# Value getters keyed by (group kind, key); a None key matches any key in the group
+METADATA_GETTERS: t.Dict[t.Tuple[str, t.Optional[str]],
+                         t.Callable[[GLib.KeyFile, str, str], t.Any]] = {
+    ("Context", None): GLib.KeyFile.get_string_list,
+    ("Extension", "autodelete"): GLib.KeyFile.get_boolean,
+    ("Extension", "no-autodownload"): GLib.KeyFile.get_boolean,
+    ("Extension", "subdirectories"): GLib.KeyFile.get_boolean,
+    ("Extension", "locale-subset"): GLib.KeyFile.get_boolean,
+    ("Extension", "versions"): GLib.KeyFile.get_string_list,
+    ("Extension", "merge-dirs"): GLib.KeyFile.get_string_list,
+    ("ExtensionOf", "priority"): GLib.KeyFile.get_integer,
+    ("Application", "required-flatpak"): GLib.KeyFile.get_string_list,
+    ("Application", "tags"): GLib.KeyFile.get_string_list,
+    ("Build", "built-extensions"): GLib.KeyFile.get_string_list,
+}
+
+VARIANT_TRUE = GLib.Variant.new_boolean(True)
+VARIANT_FALSE = GLib.Variant.new_boolean(False)
 
 log = logging.getLogger(PROGRAM_NAME)
 
@@ -48,38 +52,55 @@ log = logging.getLogger(PROGRAM_NAME)
 class Options:
     remote_name: str
     remote_url: t.Optional[str]
-    refs: t.List[str]
+    refs: t.Optional[t.FrozenSet[str]]
     pull: bool
     get_manifest: bool
+    jobs: int
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
+
+
+def get_group_kind(group: str) -> str:
+    if group.startswith("Extension "):
+        return "Extension"
+    if group == "Runtime":
+        return "Application"
+    return group
 
 
 def get_value(metadata: GLib.KeyFile,
               group: str,
-              key: str) -> t.Union[str, int, bool, t.List[str]]:
-    for group_re, key_re, cls in MEATADATA_TYPES:
-        if group_re.fullmatch(group) and key_re.fullmatch(key):
-            if cls is bool:
-                return metadata.get_boolean(group, key)
-            if cls is list:
-                return metadata.get_string_list(group, key)
-            if cls is int:
-                return metadata.get_integer(group, key)
-    return metadata.get_string(group, key)
+              key: str,
+              kind: t.Optional[str] = None) -> t.Union[str, int, bool, t.List[str]]:
+    lookup = METADATA_GETTERS.get
+    if kind is None:
+        kind = get_group_kind(group)
+    getter = lookup((kind, key)) or lookup((kind, None), GLib.KeyFile.get_string)
+    return getter(metadata, group, key)
 
 
 def metadata_to_dict(metadata: GLib.KeyFile) -> t.Dict[str, t.Any]:
     result: t.Dict[str, t.Any] = {}
+    get_keys = metadata.get_keys
+    value = get_value
     groups, _ = metadata.get_groups()
     for group in groups:
-        keys, _ = metadata.get_keys(group)
-        for key in keys:
-            if group.startswith("Extension "):
-                _, extension_id = group.split(maxsplit=1)
-                result_parent_group = result.setdefault("Extension", {})
-                result_group = result_parent_group.setdefault(extension_id, {})
-            else:
-                result_group = result.setdefault(group, {})
-            result_group[key] = get_value(metadata, group, key)
+        keys, _ = get_keys(group)
+        if not keys:
+            continue
+        kind = get_group_kind(group)
+        if kind == "Extension":
+            _, extension_id = group.split(maxsplit=1)
+            result_parent_group = result.setdefault("Extension", {})
+            result_group = result_parent_group.setdefault(extension_id, {})
+        else:
+            result_group = result.setdefault(group, {})
+        result_group.update([(key, value(metadata, group, key, kind)) for key in keys])
     return result
 
 
@@ -87,21 +108,25 @@ def load_ostree_file(ref_root: OSTree.RepoFile,
                      path: str,
                      cancellable: Gio.Cancellable = None) -> GLib.Bytes:
     repo_file = ref_root.resolve_relative_path(path)
-    file_size = repo_file.query_info(Gio.FILE_ATTRIBUTE_STANDARD_SIZE,
-                                     Gio.FileQueryInfoFlags.NONE,
-                                     cancellable).get_size()
     stream = repo_file.read(cancellable)
-    gbytes = stream.read_bytes(file_size, cancellable)
-    stream.close(cancellable)
-    return gbytes
+    try:
+        chunks = []
+        while True:
+            chunk = stream.read_bytes(65536, cancellable)
+            if chunk.get_size() == 0:
+                break
+            chunks.append(chunk.get_data())
+    finally:
+        stream.close(cancellable)
+    return GLib.Bytes.new(b"".join(chunks))
 
 
 def get_apps_metadata(installation: Flatpak.Installation,
                       remote: str,
                       opts: Options,
                       cancellable: Gio.Cancellable = None) -> \
-                      t.Iterator[t.Tuple[Flatpak.Ref,
-                                         GLib.KeyFile,
+                      t.Iterator[t.Tuple[str,
+                                         t.Dict[str, t.Any],
                                          t.Dict[str, t.Any]]]:
     def progress_cb(progress: OSTree.AsyncProgress, *args, **kwargs):
         fetched = progress.get_uint("fetched")
@@ -115,17 +140,16 @@ def get_apps_metadata(installation: Flatpak.Installation,
     repo.open(cancellable)
 
     log.info("Fetching refs from remote %s", remote)
-    refs = []
-    for ref in installation.list_remote_refs_sync_full(remote,
-                                                       Flatpak.QueryFlags.NONE,
-                                                       cancellable):
-        if opts.refs and ref.format_ref() not in opts.refs:
-            continue
-        if ref.get_arch() != "x86_64":
-            continue
-        if ref.get_eol() or ref.get_eol_rebase():
-            continue
-        refs.append(ref)
+    refs = [
+        ref
+        for ref in installation.list_remote_refs_sync_full(remote,
+                                                           Flatpak.QueryFlags.NONE,
+                                                           cancellable)
+        if ref.get_arch() == "x86_64"
+        and not (ref.get_eol() or ref.get_eol_rebase())
+        and (not opts.refs or ref.format_ref() in opts.refs)
+    ]
+    ref_names = [ref.format_ref() for ref in refs]
 
     if opts.pull:
         pull_files = ["/metadata"]
@@ -138,29 +162,41 @@ def get_apps_metadata(installation: Flatpak.Installation,
         log.info("Pulling ref files from %s", remote)
         repo.pull_with_options(remote,
                                GLib.Variant("a{sv}", {
-                                   "refs": GLib.Variant("as", [ref.format_ref() for ref in refs]),
-                                   "subdirs": GLib.Variant("as", pull_files),
-                                   "disable-static-deltas": GLib.Variant("b", True),
-                                   "gpg-verify": GLib.Variant("b", False),
+                                   "refs": GLib.Variant.new_strv(ref_names),
+                                   "subdirs": GLib.Variant.new_strv(pull_files),
+                                   "disable-static-deltas": VARIANT_TRUE,
+                                   "gpg-verify": VARIANT_FALSE,
                                }),
                                progress,
                                cancellable)
 
         progress.finish()
 
-    log.debug("Fetching metadata from %s", remote)
-    for ref in refs:
-        log.debug("Loading metadata from ref %s", ref.format_ref())
-        try:
-            _success, ref_root, _ref_commit = repo.read_commit(ref.format_ref(), cancellable)
-        except GLib.Error as err:
-            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
-                log.error("Can't read local ref: %s", err.message)  # pylint: disable=no-member
-                ref_root = None
-            else:
-                raise
-
-        metadata = GLib.KeyFile()
+    # KeyFiles are only used to convert metadata to a dict, so each worker
+    # thread reuses its own one, reloading it for every ref
+    thread_data = threading.local()
+
+    def process_ref(ref: Flatpak.Ref, ref_name: str) -> t.Tuple[str,
+                                                                 t.Dict[str, t.Any],
+                                                                 t.Dict[str, t.Any]]:
+        log.debug("Loading metadata from ref %s", ref_name)
+        if not opts.pull and not opts.get_manifest:
+            # Nothing was pulled and only the metadata is needed, which the
+            # remote summary already provides
+            ref_root = None
+        else:
+            try:
+                _success, ref_root, _ref_commit = repo.read_commit(ref_name, cancellable)
+            except GLib.Error as err:
+                if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
+                    log.error("Can't read local ref: %s", err.message)  # pylint: disable=no-member
+                    ref_root = None
+                else:
+                    raise
+
+        metadata = getattr(thread_data, "metadata", None)
+        if metadata is None:
+            metadata = thread_data.metadata = GLib.KeyFile()
         if ref_root is not None:
             metadata_bytes = load_ostree_file(ref_root, "metadata", cancellable)
         else:
@@ -170,17 +206,33 @@ def get_apps_metadata(installation: Flatpak.Installation,
         if opts.get_manifest and ref_root is not None:
             try:
                 manifest_bytes = load_ostree_file(ref_root, "files/manifest.json", cancellable)
-                with io.BytesIO(manifest_bytes.get_data()) as mf_io:
-                    manifest = json.load(mf_io)
+                manifest = orjson.loads(manifest_bytes.get_data())
             except GLib.Error as err:
                 if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
                     manifest = None
                 else:
                     raise
+            except orjson.JSONDecodeError as err:
+                log.error("Can't parse manifest of ref %s: %s", ref_name, err)
+                manifest = None
         else:
             manifest = None
 
-        yield (ref, metadata, manifest)
+        return (ref_name, metadata_to_dict(metadata), manifest)
+
+    log.debug("Fetching metadata from %s", remote)
+    # Reading commits and files from the repo is thread-safe and blocks in C code
+    # with the GIL released, so load refs concurrently while keeping output order.
+    # Only keep a bounded number of refs in flight, so that workers stay ahead of
+    # the consumer without piling up loaded refs in memory
+    with ThreadPoolExecutor(max_workers=opts.jobs) as executor:
+        pending: t.Deque[Future] = collections.deque()
+        for ref, ref_name in zip(refs, ref_names):
+            if len(pending) >= opts.jobs * 2:
+                yield pending.popleft().result()
+            pending.append(executor.submit(process_ref, ref, ref_name))
+        while pending:
+            yield pending.popleft().result()
 
 
 def main():
@@ -189,15 +241,17 @@ def main():
     parser.add_argument("-r", "--ref", nargs="+")
     parser.add_argument("--no-pull", action="store_true")
     parser.add_argument("--no-manifest", action="store_true")
+    parser.add_argument("-j", "--jobs", type=positive_int, default=(os.cpu_count() or 1) * 4)
     parser.add_argument("-v", "--verbose", action="store_true")
     parser.add_argument("repo_name")
     args = parser.parse_args()
 
     opts = Options(remote_name=args.repo_name,
                    remote_url=args.url,
-                   refs=args.ref,
+                   refs=frozenset(args.ref) if args.ref else None,
                    pull=not args.no_pull,
-                   get_manifest=not args.no_manifest)
+                   get_manifest=not args.no_manifest,
+                   jobs=args.jobs)
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
@@ -228,16 +282,18 @@ def main():
         else:
             raise
 
-    result = []
-
-    for ref, metadata, manifest in get_apps_metadata(inst, remote.get_name(), opts, cancellable):
-        result.append({
-            "ref": ref.format_ref(),
-            "metadata": metadata_to_dict(metadata),
+    # Write refs out as they are loaded instead of collecting the whole list first
+    out = sys.stdout.buffer
+    separator = b"[\n"
+    for ref_name, metadata, manifest in get_apps_metadata(inst, remote.get_name(), opts, cancellable):
+        out.write(separator)
+        out.write(orjson.dumps({
+            "ref": ref_name,
+            "metadata": metadata,
             "manifest": manifest,
-        })
-
-    json.dump(result, sys.stdout, indent=4)
+        }, option=orjson.OPT_INDENT_2))
+        separator = b",\n"
+    out.write(b"\n]\n" if separator == b",\n" else b"[]\n")
 
 
 if __name__ == "__main__":